@@ -1,7 +1,12 @@
 #!/usr/bin/env python3
+import abc
 import argparse
 import hashlib
+import json
 import subprocess
+from typing import Callable
+from typing import Dict
+from typing import List
 from typing import NamedTuple
 from typing import Optional
 from typing import Sequence
@@ -21,10 +26,330 @@ class ImageKey(NamedTuple):
     packages_hash: str
 
 
+class Layer(NamedTuple):
+    id: str  # `<missing>` for layers docker has no local image for
+    created_by: str
+
+
+class LayerDivergence(NamedTuple):
+    layer: int  # 0-based index counted from the base image
+    source_command: Optional[str]
+    target_command: Optional[str]
+
+
 class ImageNotFoundError(ValueError):
     pass
 
 
+_MISSING_LAYER_ID = '<missing>'
+
+
+def _no_log(message: str) -> None:
+    pass
+
+
+class Backend(abc.ABC):
+    @abc.abstractmethod
+    def inspect(self, image_uri: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def pull(self, image_uri: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def tag(self, source: str, target: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def push(self, image_uri: str) -> None:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def history(self, image_uri: str) -> Tuple[Layer, ...]:
+        raise NotImplementedError
+
+    @abc.abstractmethod
+    def run(self, image_uri: str, command: Tuple[str, ...]) -> str:
+        raise NotImplementedError
+
+    def layer_chain(self, image_uri: str) -> Tuple[str, ...]:
+        return get_layer_chain(self.history(image_uri))
+
+    def describe_tag(self, source: str, target: str) -> str:
+        return f'Would tag {source} as {target}'
+
+    def describe_push(self, image_uri: str) -> str:
+        return f'Would push {image_uri}'
+
+
+class DockerCliBackend(Backend):
+    def __init__(self, *, log: Callable[[str], None] = _no_log) -> None:
+        self._log = log
+
+    def inspect(self, image_uri: str) -> None:
+        try:
+            self._check_output(('docker', 'inspect', image_uri))
+        except subprocess.CalledProcessError as e:
+            raise ImageNotFoundError(
+                f'The image {image_uri} was not found'
+            ) from e
+
+    def pull(self, image_uri: str) -> None:
+        try:
+            self._check_output(('docker', 'pull', image_uri))
+        except subprocess.CalledProcessError as e:
+            raise ImageNotFoundError(
+                f'The image {image_uri} was not found'
+            ) from e
+
+    def tag(self, source: str, target: str) -> None:
+        self._check_output(('docker', 'tag', source, target))
+
+    def push(self, image_uri: str) -> None:
+        self._check_output(('docker', 'push', image_uri))
+
+    def describe_tag(self, source: str, target: str) -> str:
+        return ' '.join(('#', 'docker', 'tag', source, target))
+
+    def describe_push(self, image_uri: str) -> str:
+        return ' '.join(('#', 'docker', 'push', image_uri))
+
+    def history(self, image_uri: str) -> Tuple[Layer, ...]:
+        image_commands = self._check_output((
+            'docker',
+            'history',
+            '--no-trunc',
+            '--format',
+            '[{{json .ID}}, {{json .CreatedBy}}]',
+            image_uri,
+        ))
+        self._log(f'Docker commands for {image_uri}:\n{image_commands}')
+        return tuple(
+            Layer(*json.loads(line)) for line in image_commands.splitlines()
+        )
+
+    def run(self, image_uri: str, command: Tuple[str, ...]) -> str:
+        output = self._check_output((
+            'docker',
+            'run',
+            '--rm',
+            '--net=none',
+            '--user=nobody',
+            image_uri,
+            *command,
+        ))
+        self._log(f'Output of {" ".join(command)} for {image_uri}:\n{output}')
+        return output
+
+    def _check_output(self, command: Tuple[str, ...]) -> str:
+        self._log(' '.join(command))
+        return subprocess.check_output(command, encoding='utf-8')
+
+
+class LayerChainCache:
+    def __init__(self) -> None:
+        self._chains: Dict[str, Tuple[str, ...]] = {}
+
+    def chain(self, history: Tuple[Layer, ...]) -> Tuple[str, ...]:
+        # `docker history` lists the newest layer first
+        layers = history[::-1]
+        chain: Tuple[str, ...] = ()
+        for layer in reversed(layers):
+            cached = self._chains.get(layer.id)
+            if cached is not None:
+                chain = cached
+                break
+        digest = chain[-1] if chain else ''
+        for layer in layers[len(chain):]:
+            digest = _get_digest(f'{digest}\n{layer.created_by}'.encode())
+            chain += (digest,)
+            if layer.id != _MISSING_LAYER_ID:
+                self._chains[layer.id] = chain
+        return chain
+
+
+class _MemoizedBackend(Backend):
+    def __init__(self, backend: Backend, layer_cache: LayerChainCache) -> None:
+        self._backend = backend
+        self._layer_cache = layer_cache
+        self._histories: Dict[str, Tuple[Layer, ...]] = {}
+
+    def inspect(self, image_uri: str) -> None:
+        self._backend.inspect(image_uri)
+
+    def pull(self, image_uri: str) -> None:
+        self._backend.pull(image_uri)
+
+    def tag(self, source: str, target: str) -> None:
+        self._backend.tag(source, target)
+
+    def push(self, image_uri: str) -> None:
+        self._backend.push(image_uri)
+
+    def history(self, image_uri: str) -> Tuple[Layer, ...]:
+        if image_uri not in self._histories:
+            self._histories[image_uri] = self._backend.history(image_uri)
+        return self._histories[image_uri]
+
+    def run(self, image_uri: str, command: Tuple[str, ...]) -> str:
+        return self._backend.run(image_uri, command)
+
+    def layer_chain(self, image_uri: str) -> Tuple[str, ...]:
+        return self._layer_cache.chain(self.history(image_uri))
+
+
+KeyFunc = Callable[[Backend, str], ImageKey]
+
+
+def get_layer_chain(history: Tuple[Layer, ...]) -> Tuple[str, ...]:
+    return LayerChainCache().chain(history)
+
+
+def find_divergence(
+    backend: Backend,
+    source: str,
+    target: str,
+) -> Optional[LayerDivergence]:
+    source_history = backend.history(source)
+    target_history = backend.history(target)
+    source_chain = backend.layer_chain(source)
+    target_chain = backend.layer_chain(target)
+    # chains that match at a layer also match at every layer below it
+    layer = min(len(source_chain), len(target_chain))
+    while layer > 0 and source_chain[layer - 1] != target_chain[layer - 1]:
+        layer -= 1
+    if layer == len(source_chain) == len(target_chain):
+        return None
+
+    def _command(history: Tuple[Layer, ...]) -> Optional[str]:
+        if layer < len(history):
+            return history[len(history) - 1 - layer].created_by
+        else:
+            return None
+
+    return LayerDivergence(
+        layer=layer,
+        source_command=_command(source_history),
+        target_command=_command(target_history),
+    )
+
+
+def get_commands_hash(backend: Backend, image_uri: str) -> str:
+    chain = backend.layer_chain(image_uri)
+    return chain[-1] if chain else _get_digest(b'')
+
+
+def get_packages_hash(backend: Backend, image_uri: str) -> str:
+    packages = backend.run(image_uri, ('dpkg', '-l'))
+    return _get_digest(packages.encode())
+
+
+def get_image_key(backend: Backend, image_uri: str) -> ImageKey:
+    return ImageKey(
+        commands_hash=get_commands_hash(backend, image_uri),
+        packages_hash=get_packages_hash(backend, image_uri),
+    )
+
+
+class PromoteResult(NamedTuple):
+    source: str
+    target: str
+    target_found: bool
+    changed: bool
+    source_key: Optional[ImageKey]
+    target_key: Optional[ImageKey]
+    divergence: Optional[LayerDivergence]
+    pushed: Tuple[str, ...]
+
+
+class Promoter:
+    def __init__(
+        self,
+        backend: Backend,
+        *,
+        key_func: KeyFunc = get_image_key,
+        dry_run: bool = False,
+        report_divergence: bool = False,
+        layer_cache: Optional[LayerChainCache] = None,
+        log: Callable[[str], None] = _no_log,
+    ) -> None:
+        self._backend = backend
+        self._key_func = key_func
+        self._dry_run = dry_run
+        self._report_divergence = report_divergence
+        self._layer_cache = layer_cache or LayerChainCache()
+        self._log = log
+
+    def promote(self, source: str, target: str) -> PromoteResult:
+        images_to_push: List[str] = [source]
+        self._log('Pushing source image')
+        self.push(source)
+        source_key: Optional[ImageKey] = None
+        target_key: Optional[ImageKey] = None
+        divergence: Optional[LayerDivergence] = None
+        backend = _MemoizedBackend(self._backend, self._layer_cache)
+        try:
+            self._log('Pulling target image...')
+            backend.pull(target)
+        except ImageNotFoundError:
+            self._log(
+                f'Target image {target} was not found in the registry. '
+                'Going to attempt to tag and push the target image anyway.'
+            )
+            target_found = False
+            changed = True
+        else:
+            target_found = True
+            source_key = self._key_func(backend, source)
+            target_key = self._key_func(backend, target)
+            self._log(f'Source key: {source_key}')
+            self._log(f'Target key: {target_key}')
+            changed = source_key != target_key
+            if (
+                    self._report_divergence and
+                    source_key.commands_hash != target_key.commands_hash
+            ):
+                divergence = find_divergence(backend, source, target)
+                self._log(f'Docker commands diverge: {divergence}')
+            if changed:
+                self._log('Image has changed. Pushing a new image.')
+            else:
+                self._log('Image has NOT changed. Keeping the old target.')
+
+        if changed:
+            self.tag(source, target)
+            self.push(target)
+            images_to_push.append(target)
+
+        return PromoteResult(
+            source=source,
+            target=target,
+            target_found=target_found,
+            changed=changed,
+            source_key=source_key,
+            target_key=target_key,
+            divergence=divergence,
+            pushed=() if self._dry_run else tuple(images_to_push),
+        )
+
+    def tag(self, source: str, target: str) -> None:
+        self._log(f'Tagging image {source} as {target}')
+        if self._dry_run:
+            self._log('Image was not actually tagged since this is a dry run')
+            self._log(self._backend.describe_tag(source, target))
+        else:
+            self._backend.tag(source, target)
+
+    def push(self, image_uri: str) -> None:
+        self._log(f'Pushing image {image_uri} ...')
+        if self._dry_run:
+            self._log('Image was not actually pushed since this is a dry run')
+            self._log(self._backend.describe_push(image_uri))
+        else:
+            self._backend.push(image_uri)
+
+
 def main(argv: Optional[Sequence[str]] = None) -> int:
     parser = argparse.ArgumentParser()
     parser.add_argument(
@@ -49,16 +374,20 @@ def main(argv: Optional[Sequence[str]] = None) -> int:
     )
     arguments = parser.parse_args(argv)
 
+    backend = DockerCliBackend(log=print)
+
     source_image = _get_image(arguments.source)
-    _validate_source(source_image)
+    _validate_source(backend, source_image)
 
     target_image = _get_sanitized_target(arguments.target, source_image)
 
-    _docker_push_latest_if_changed(
-        source_image.uri,
-        target_image.uri,
-        is_dry_run=arguments.dry_run,
+    promoter = Promoter(
+        backend,
+        dry_run=arguments.dry_run,
+        report_divergence=True,
+        log=print,
     )
+    promoter.promote(source_image.uri, target_image.uri)
     return 0
 
 
@@ -76,18 +405,13 @@ def _get_image(uri: str) -> Image:
     return Image(host=host, name=name, tag=tag, uri=uri)
 
 
-def _validate_source(source_image: Image) -> None:
+def _validate_source(backend: Backend, source_image: Image) -> None:
     if not source_image.tag:
         raise ValueError(
             f'The source image {source_image.uri} does not have a tag! '
             'You must include a tag in the source parameter.'
         )
-    try:
-        subprocess.check_output(('docker', 'inspect', source_image.uri))
-    except subprocess.CalledProcessError as e:
-        raise ImageNotFoundError(
-            f'The image {source_image.uri} was not found'
-        ) from e
+    backend.inspect(source_image.uri)
 
 
 def _get_sanitized_target(target: str, source_image: Image) -> Image:
@@ -105,119 +429,9 @@ def _get_sanitized_target(target: str, source_image: Image) -> Image:
     return target_image
 
 
-def _docker_push_latest_if_changed(
-    source: str,
-    target: str,
-    *,
-    is_dry_run: bool
-) -> None:
-    print('Pushing source image')
-    _push_image(source, is_dry_run=is_dry_run)
-    try:
-        print('Pulling target image...')
-        _pull_image(target)
-    except ImageNotFoundError:
-        print(
-            f'Target image {target} was not found in the registry. '
-            'Going to attempt to tag and push the target image anyway.'
-        )
-        _tag_image(source, target, is_dry_run=is_dry_run)
-        _push_image(target, is_dry_run=is_dry_run)
-    else:
-        if _has_image_changed(source, target):
-            print('Image has changed. Pushing a new image.')
-            _tag_image(source, target, is_dry_run=is_dry_run)
-            _push_image(target, is_dry_run=is_dry_run)
-        else:
-            print('Image has NOT changed. Keeping the old target.')
-
-
-def _pull_image(image_uri: str) -> None:
-    pull_command = ('docker', 'pull', image_uri)
-    try:
-        _check_output_and_print(pull_command)
-    except subprocess.CalledProcessError as e:
-        raise ImageNotFoundError(f'The image {image_uri} was not found') from e
-
-
-def _tag_image(source: str, target: str, *, is_dry_run: bool) -> None:
-    print(f'Tagging image {source} as {target}')
-    tag_command: Tuple[str, ...] = ('docker', 'tag', source, target)
-    if is_dry_run:
-        tag_command = ('#',) + tag_command
-        print('Image was not actually tagged since this is a dry run')
-        print(' '.join(tag_command))
-    else:
-        _check_output_and_print(tag_command)
-
-
-def _push_image(image_uri: str, *, is_dry_run: bool) -> None:
-    print(f'Pushing image {image_uri} ...')
-    push_command: Tuple[str, ...] = ('docker', 'push', image_uri)
-    if is_dry_run:
-        push_command = ('#',) + push_command
-        print('Image was not actually pushed since this is a dry run')
-        print(' '.join(push_command))
-    else:
-        _check_output_and_print(push_command)
-
-
-def _has_image_changed(source: str, target: str) -> bool:
-    source_key = _get_image_key(source)
-    target_key = _get_image_key(target)
-    print(f'Source key: {source_key}')
-    print(f'Target key: {target_key}')
-    return source_key != target_key
-
-
-def _get_image_key(image_uri: str) -> ImageKey:
-    return ImageKey(
-        commands_hash=_get_commands_hash(image_uri),
-        packages_hash=_get_packages_hash(image_uri),
-    )
-
-
-def _get_commands_hash(image_uri: str) -> str:
-    image_commands = _check_output_and_print((
-        'docker',
-        'history',
-        '--no-trunc',
-        '--format',
-        '{{.CreatedBy}}',
-        image_uri,
-    ))
-    print(f'Docker commands for {image_uri}:\n{image_commands}')
-    return _get_digest(image_commands.encode())
-
-
-def _get_packages_hash(image_uri: str) -> str:
-    packages = _run_in_image(image_uri, ('dpkg', '-l'))
-    print(f'Packages for {image_uri}:\n{packages}')
-    return _get_digest(packages.encode())
-
-
 def _get_digest(blob: bytes) -> str:
     return hashlib.sha256(blob).hexdigest()
 
 
-def _run_in_image(image_uri: str, command: Tuple[str, ...]) -> str:
-    run_command = (
-        'docker',
-        'run',
-        '--rm',
-        '--net=none',
-        '--user=nobody',
-        image_uri,
-        *command,
-    )
-    return _check_output_and_print(run_command)
-
-
-def _check_output_and_print(command: Tuple[str, ...]) -> str:
-    print(' '.join(command))
-    output = subprocess.check_output(command, encoding='utf-8')
-    return output
-
-
 if __name__ == '__main__':
     exit(main())
@@ -1,12 +1,18 @@
+import hashlib
 import http
 import json
 import subprocess
 import urllib.request
 from typing import Any
 from typing import Dict
+from typing import List
+from typing import Tuple
 from urllib.error import HTTPError
 
+from docker_push_latest_if_changed import Backend
 from docker_push_latest_if_changed import Image
+from docker_push_latest_if_changed import ImageNotFoundError
+from docker_push_latest_if_changed import Layer
 
 
 def is_image_on_registry(image: Image) -> bool:
@@ -57,3 +63,60 @@ def get_manifest(image: Image) -> Dict[str, Any]:
     )
     response = urllib.request.urlopen(manifest_uri).read()
     return json.loads(response)
+
+
+def make_history(commands: Tuple[str, ...]) -> Tuple[Layer, ...]:
+    layers = []
+    layer_id = ''
+    for command in reversed(commands):
+        layer_id = hashlib.sha256(f'{layer_id}{command}'.encode()).hexdigest()
+        layers.append(Layer(id=f'sha256:{layer_id}', created_by=command))
+    return tuple(reversed(layers))
+
+
+class FakeBackend(Backend):
+    def __init__(self) -> None:
+        self.local: Dict[str, Tuple[Tuple[Layer, ...], str]] = {}
+        self.registry: Dict[str, Tuple[Tuple[Layer, ...], str]] = {}
+        self.pushed: List[str] = []
+
+    def add_local_image(
+        self,
+        image_uri: str,
+        history: Tuple[str, ...],
+        packages: str,
+    ) -> None:
+        self.local[image_uri] = (make_history(history), packages)
+
+    def add_registry_image(
+        self,
+        image_uri: str,
+        history: Tuple[str, ...],
+        packages: str,
+    ) -> None:
+        self.registry[image_uri] = (make_history(history), packages)
+
+    def inspect(self, image_uri: str) -> None:
+        if image_uri not in self.local:
+            raise ImageNotFoundError(f'The image {image_uri} was not found')
+
+    def pull(self, image_uri: str) -> None:
+        if image_uri not in self.registry:
+            raise ImageNotFoundError(f'The image {image_uri} was not found')
+        self.local[image_uri] = self.registry[image_uri]
+
+    def tag(self, source: str, target: str) -> None:
+        self.local[target] = self.local[source]
+
+    def push(self, image_uri: str) -> None:
+        self.registry[image_uri] = self.local[image_uri]
+        self.pushed.append(image_uri)
+
+    def history(self, image_uri: str) -> Tuple[Layer, ...]:
+        history, _ = self.local[image_uri]
+        return history
+
+    def run(self, image_uri: str, command: Tuple[str, ...]) -> str:
+        assert command == ('dpkg', '-l'), command
+        _, packages = self.local[image_uri]
+        return packages
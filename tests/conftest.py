@@ -9,6 +9,7 @@ import urllib.request
 import pytest
 from ephemeral_port_reserve import reserve
 
+from docker_push_latest_if_changed import DockerCliBackend
 from testing.helpers import inspect_image
 
 
@@ -18,6 +19,11 @@ TESTING_IMAGES_PATH = os.path.abspath(
 )
 
 
+@pytest.fixture
+def docker_cli():
+    return DockerCliBackend(log=print)
+
+
 @pytest.fixture
 def fake_docker_registry():
     port = reserve()
@@ -1,16 +1,29 @@
 import re
+import subprocess
+from unittest import mock
 
 import pytest
 
+import docker_push_latest_if_changed
 from docker_push_latest_if_changed import _get_image
-from docker_push_latest_if_changed import _push_image
-from docker_push_latest_if_changed import _tag_image
+from docker_push_latest_if_changed import _MemoizedBackend
+from docker_push_latest_if_changed import Backend
+from docker_push_latest_if_changed import DockerCliBackend
+from docker_push_latest_if_changed import find_divergence
+from docker_push_latest_if_changed import get_commands_hash
+from docker_push_latest_if_changed import get_layer_chain
 from docker_push_latest_if_changed import ImageKey
 from docker_push_latest_if_changed import ImageNotFoundError
+from docker_push_latest_if_changed import Layer
+from docker_push_latest_if_changed import LayerChainCache
+from docker_push_latest_if_changed import LayerDivergence
 from docker_push_latest_if_changed import main
+from docker_push_latest_if_changed import Promoter
 from testing.helpers import are_two_images_on_registry_the_same
+from testing.helpers import FakeBackend
 from testing.helpers import is_image_on_registry
 from testing.helpers import is_local_image_the_same_on_registry
+from testing.helpers import make_history
 
 
 IMAGE_KEY_RE_SUFFIX = (
@@ -24,18 +37,19 @@ def test_push_new_image(
     fake_docker_registry,
     fake_image_foo_name,
     fake_image_bar_name,
+    docker_cli,
 ):
     source = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}:foo')
-    _tag_image(source.name, source.uri, is_dry_run=False)
+    docker_cli.tag(source.name, source.uri)
 
     target = _get_image(f'{fake_docker_registry}/{fake_image_bar_name}:latest')
-    _tag_image(target.name, target.uri, is_dry_run=False)
+    docker_cli.tag(target.name, target.uri)
 
     assert not is_image_on_registry(source)
     assert not is_image_on_registry(target)
-    _push_image(target.uri, is_dry_run=False)
+    docker_cli.push(target.uri)
     out, _ = capsys.readouterr()
-    assert f'Pushing image {target.uri}' in out
+    assert f'docker push {target.uri}' in out
     assert not is_image_on_registry(source)
     assert is_image_on_registry(target)
 
@@ -50,18 +64,19 @@ def test_push_new_image_dry_run(
     fake_docker_registry,
     fake_image_foo_name,
     fake_image_bar_name,
+    docker_cli,
 ):
     source = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}:foo')
-    _tag_image(source.name, source.uri, is_dry_run=False)
+    docker_cli.tag(source.name, source.uri)
 
     target = _get_image(f'{fake_docker_registry}/{fake_image_bar_name}:latest')
-    _tag_image(target.name, target.uri, is_dry_run=False)
+    docker_cli.tag(target.name, target.uri)
 
     assert not is_image_on_registry(source)
     assert not is_image_on_registry(target)
-    _push_image(target.uri, is_dry_run=False)
+    docker_cli.push(target.uri)
     out, _ = capsys.readouterr()
-    assert f'Pushing image {target.uri}' in out
+    assert f'docker push {target.uri}' in out
     assert not is_image_on_registry(source)
     assert is_image_on_registry(target)
 
@@ -69,22 +84,29 @@ def test_push_new_image_dry_run(
     out, _ = capsys.readouterr()
     assert 'Image was not actually tagged since this is a dry run' in out
     assert 'Image was not actually pushed since this is a dry run' in out
+    assert f'# docker tag {source.uri} {target.uri}' in out
+    assert f'# docker push {target.uri}' in out
     assert not is_image_on_registry(source)
     assert is_image_on_registry(target)
 
 
-def test_two_same_images(capsys, fake_docker_registry, fake_image_foo_name):
+def test_two_same_images(
+    capsys,
+    fake_docker_registry,
+    fake_image_foo_name,
+    docker_cli,
+):
     source = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}:foo')
-    _tag_image(source.name, source.uri, is_dry_run=False)
+    docker_cli.tag(source.name, source.uri)
 
     target = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}:latest')
-    _tag_image(target.name, target.uri, is_dry_run=False)
+    docker_cli.tag(target.name, target.uri)
 
     assert not is_image_on_registry(source)
     assert not is_image_on_registry(target)
-    _push_image(target.uri, is_dry_run=False)
+    docker_cli.push(target.uri)
     out, _ = capsys.readouterr()
-    assert f'Pushing image {target.uri}' in out
+    assert f'docker push {target.uri}' in out
     assert not is_image_on_registry(source)
     assert is_image_on_registry(target)
 
@@ -100,21 +122,22 @@ def test_two_same_images_with_different_packages(
     capsys,
     fake_docker_registry,
     fake_baz_dummy_deb_images,
+    docker_cli,
 ):
     baz_dummy_deb_name, baz_no_dummy_deb_name = fake_baz_dummy_deb_images
     source = _get_image(f'{fake_docker_registry}/{baz_dummy_deb_name}:baz')
-    _tag_image(source.name, source.uri, is_dry_run=False)
+    docker_cli.tag(source.name, source.uri)
 
     target = _get_image(
         f'{fake_docker_registry}/{baz_no_dummy_deb_name}:latest'
     )
-    _tag_image(target.name, target.uri, is_dry_run=False)
+    docker_cli.tag(target.name, target.uri)
 
     assert not is_image_on_registry(source)
     assert not is_image_on_registry(target)
-    _push_image(target.uri, is_dry_run=False)
+    docker_cli.push(target.uri)
     out, _ = capsys.readouterr()
-    assert f'Pushing image {target.uri}' in out
+    assert f'docker push {target.uri}' in out
     assert not is_image_on_registry(source)
     assert is_image_on_registry(target)
 
@@ -140,9 +163,9 @@ def test_two_same_images_with_different_packages(
     assert is_local_image_the_same_on_registry(source, target)
 
 
-def test_no_target(fake_docker_registry, fake_image_foo_name):
+def test_no_target(fake_docker_registry, fake_image_foo_name, docker_cli):
     source = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}:foo')
-    _tag_image(fake_image_foo_name, source.uri, is_dry_run=False)
+    docker_cli.tag(fake_image_foo_name, source.uri)
 
     expected_target = _get_image(
         f'{fake_docker_registry}/{fake_image_foo_name}:latest'
@@ -155,12 +178,16 @@ def test_no_target(fake_docker_registry, fake_image_foo_name):
     assert is_local_image_the_same_on_registry(source, expected_target)
 
 
-def test_no_previous_image(fake_docker_registry, fake_image_foo_name):
+def test_no_previous_image(
+    fake_docker_registry,
+    fake_image_foo_name,
+    docker_cli,
+):
     source = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}:foo')
-    _tag_image(fake_image_foo_name, source.uri, is_dry_run=False)
+    docker_cli.tag(fake_image_foo_name, source.uri)
 
     target = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}:latest')
-    _tag_image(target.name, target.uri, is_dry_run=False)
+    docker_cli.tag(target.name, target.uri)
 
     assert not is_image_on_registry(source)
     assert not is_image_on_registry(target)
@@ -170,12 +197,16 @@ def test_no_previous_image(fake_docker_registry, fake_image_foo_name):
     assert is_local_image_the_same_on_registry(source, target)
 
 
-def test_omit_target_tag(fake_docker_registry, fake_image_foo_name):
+def test_omit_target_tag(
+    fake_docker_registry,
+    fake_image_foo_name,
+    docker_cli,
+):
     source = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}:foo')
-    _tag_image(fake_image_foo_name, source.uri, is_dry_run=False)
+    docker_cli.tag(fake_image_foo_name, source.uri)
 
     target = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}')
-    _tag_image(target.name, target.uri, is_dry_run=False)
+    docker_cli.tag(target.name, target.uri)
 
     assert not is_image_on_registry(source)
     assert not is_image_on_registry(target)
@@ -189,12 +220,16 @@ def test_omit_target_tag(fake_docker_registry, fake_image_foo_name):
     assert is_local_image_the_same_on_registry(source, expected_target)
 
 
-def test_source_has_no_tag(fake_docker_registry, fake_image_foo_name):
+def test_source_has_no_tag(
+    fake_docker_registry,
+    fake_image_foo_name,
+    docker_cli,
+):
     source = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}')
-    _tag_image(fake_image_foo_name, source.uri, is_dry_run=False)
+    docker_cli.tag(fake_image_foo_name, source.uri)
 
     target = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}:latest')
-    _tag_image(target.name, target.uri, is_dry_run=False)
+    docker_cli.tag(target.name, target.uri)
 
     with pytest.raises(ValueError) as excinfo:
         main(('--source', source.uri, '--target', target.uri))
@@ -205,12 +240,13 @@ def test_source_and_target_have_the_same_tag(
     fake_docker_registry,
     fake_image_foo_name,
     fake_image_bar_name,
+    docker_cli,
 ):
     source = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}:latest')
-    _tag_image(fake_image_foo_name, source.uri, is_dry_run=False)
+    docker_cli.tag(fake_image_foo_name, source.uri)
 
     target = _get_image(f'{fake_docker_registry}/{fake_image_foo_name}:latest')
-    _tag_image(target.name, target.uri, is_dry_run=False)
+    docker_cli.tag(target.name, target.uri)
 
     with pytest.raises(ValueError) as excinfo:
         main(('--source', source.uri, '--target', target.uri))
@@ -222,6 +258,7 @@ def test_image_doesnt_exist():
     with pytest.raises(ImageNotFoundError) as excinfo:
         main(('--source', source.uri))
     assert f'The image {source.uri} was not found' in str(excinfo.value)
+    assert isinstance(excinfo.value.__cause__, subprocess.CalledProcessError)
 
 
 def test_invalid_image_name():
@@ -230,3 +267,226 @@ def test_invalid_image_name():
         main(('--source', fake_invalid_image_name))
     msg = str(excinfo.value)
     assert f'Image uri {fake_invalid_image_name} is malformed' in msg
+
+
+def test_incomplete_backend_cannot_be_constructed():
+    class PushOnlyBackend(Backend):
+        def push(self, image_uri):
+            pass
+
+    with pytest.raises(TypeError):
+        PushOnlyBackend()
+
+
+def test_promoter_target_not_found():
+    backend = FakeBackend()
+    backend.add_local_image('img:new', ('CMD a',), 'pkgs')
+
+    result = Promoter(backend).promote('img:new', 'img:latest')
+
+    assert not result.target_found
+    assert result.changed
+    assert result.source_key is None
+    assert result.pushed == ('img:new', 'img:latest')
+    assert backend.pushed == ['img:new', 'img:latest']
+
+
+def test_promoter_unchanged():
+    backend = FakeBackend()
+    backend.add_local_image('img:new', ('CMD a',), 'pkgs')
+    backend.add_registry_image('img:latest', ('CMD a',), 'pkgs')
+
+    result = Promoter(backend).promote('img:new', 'img:latest')
+
+    assert result.target_found
+    assert not result.changed
+    assert result.source_key == result.target_key
+    assert result.pushed == ('img:new',)
+    assert backend.pushed == ['img:new']
+
+
+def test_promoter_changed_packages():
+    backend = FakeBackend()
+    backend.add_local_image('img:new', ('CMD a',), 'pkgs v2')
+    backend.add_registry_image('img:latest', ('CMD a',), 'pkgs v1')
+
+    result = Promoter(backend).promote('img:new', 'img:latest')
+
+    assert result.changed
+    assert result.source_key.commands_hash == result.target_key.commands_hash
+    assert result.source_key.packages_hash != result.target_key.packages_hash
+    assert result.divergence is None
+    assert backend.pushed == ['img:new', 'img:latest']
+    assert backend.local['img:latest'] == backend.local['img:new']
+
+
+def test_promoter_dry_run():
+    backend = FakeBackend()
+    backend.add_local_image('img:new', ('CMD b',), 'pkgs')
+    backend.add_registry_image('img:latest', ('CMD a',), 'pkgs')
+
+    messages = []
+    promoter = Promoter(backend, dry_run=True, log=messages.append)
+    result = promoter.promote('img:new', 'img:latest')
+
+    assert result.changed
+    assert result.pushed == ()
+    assert backend.pushed == []
+    assert 'Would tag img:new as img:latest' in messages
+    assert 'Would push img:latest' in messages
+
+
+def test_docker_cli_describes_dry_run_commands():
+    backend = DockerCliBackend()
+    assert backend.describe_tag('img:new', 'img:latest') == (
+        '# docker tag img:new img:latest'
+    )
+    assert backend.describe_push('img:new') == '# docker push img:new'
+
+
+def test_promoter_changed_commands():
+    backend = FakeBackend()
+    backend.add_local_image('img:new', ('RUN c2', 'RUN b', 'FROM a'), 'pkgs')
+    backend.add_registry_image(
+        'img:latest', ('RUN c1', 'RUN b', 'FROM a'), 'pkgs',
+    )
+
+    promoter = Promoter(backend, report_divergence=True)
+    result = promoter.promote('img:new', 'img:latest')
+
+    assert result.changed
+    assert result.divergence == LayerDivergence(
+        layer=2, source_command='RUN c2', target_command='RUN c1',
+    )
+    assert backend.pushed == ['img:new', 'img:latest']
+
+
+def test_promoter_divergence_is_opt_in():
+    backend = FakeBackend()
+    backend.add_local_image('img:new', ('RUN c2', 'FROM a'), 'pkgs')
+    backend.add_registry_image('img:latest', ('RUN c1', 'FROM a'), 'pkgs')
+
+    result = Promoter(backend).promote('img:new', 'img:latest')
+
+    assert result.changed
+    assert result.divergence is None
+
+
+def test_promoter_reuses_layer_chains_across_promotes():
+    backend = FakeBackend()
+    backend.add_local_image('img:1', ('RUN c1', 'RUN b', 'FROM a'), 'pkgs')
+    backend.add_local_image('img:2', ('RUN c2', 'RUN b', 'FROM a'), 'pkgs')
+    backend.add_registry_image(
+        'img:latest', ('RUN c0', 'RUN b', 'FROM a'), 'pkgs',
+    )
+    promoter = Promoter(backend)
+    promoter.promote('img:1', 'img:latest')
+
+    with mock.patch.object(
+        docker_push_latest_if_changed,
+        '_get_digest',
+        wraps=docker_push_latest_if_changed._get_digest,
+    ) as get_digest:
+        promoter.promote('img:2', 'img:latest')
+
+    # only `RUN c2` is hashed into a chain, plus the two `dpkg -l` outputs
+    assert get_digest.call_count == 3
+
+
+def test_layer_chain_cache_skips_seen_prefix():
+    cache = LayerChainCache()
+    base = cache.chain(make_history(('RUN b', 'FROM a')))
+
+    with mock.patch.object(
+        docker_push_latest_if_changed,
+        '_get_digest',
+        wraps=docker_push_latest_if_changed._get_digest,
+    ) as get_digest:
+        child = cache.chain(make_history(('RUN c', 'RUN b', 'FROM a')))
+
+    assert get_digest.call_count == 1
+    assert child[:2] == base
+    assert child == get_layer_chain(make_history(('RUN c', 'RUN b', 'FROM a')))
+
+
+def test_layer_chain_cache_missing_layer_ids():
+    cache = LayerChainCache()
+    history = (
+        Layer(id='sha256:top', created_by='RUN b'),
+        Layer(id='<missing>', created_by='FROM a'),
+    )
+
+    assert cache.chain(history) == get_layer_chain(make_history(
+        ('RUN b', 'FROM a'),
+    ))
+    assert cache.chain(history[1:]) == get_layer_chain(history[1:])
+
+
+def test_memoized_backend_delegates():
+    fake = FakeBackend()
+    fake.add_local_image('img:new', ('FROM a',), 'pkgs')
+    backend = _MemoizedBackend(fake, LayerChainCache())
+
+    backend.inspect('img:new')
+    backend.tag('img:new', 'img:latest')
+    backend.push('img:latest')
+    backend.pull('img:latest')
+    with pytest.raises(ImageNotFoundError):
+        backend.inspect('img:missing')
+
+    assert fake.local['img:latest'] == fake.local['img:new']
+    assert fake.pushed == ['img:latest']
+
+
+def test_get_layer_chain_shares_base_prefix():
+    base = get_layer_chain(make_history(('RUN b', 'FROM a')))
+    child = get_layer_chain(make_history(('RUN c', 'RUN b', 'FROM a')))
+    assert child[:2] == base
+    assert len(child) == 3
+
+
+def test_find_divergence_same_history():
+    backend = FakeBackend()
+    backend.add_local_image('img:new', ('RUN b', 'FROM a'), 'pkgs')
+    backend.add_local_image('img:latest', ('RUN b', 'FROM a'), 'pkgs')
+    assert find_divergence(backend, 'img:new', 'img:latest') is None
+
+
+@pytest.mark.parametrize(
+    ('source_history', 'target_history', 'expected'),
+    (
+        (
+            ('RUN c2', 'RUN b', 'FROM a'),
+            ('RUN c1', 'RUN b', 'FROM a'),
+            LayerDivergence(2, 'RUN c2', 'RUN c1'),
+        ),
+        (
+            ('RUN c', 'RUN b2', 'FROM a'),
+            ('RUN c', 'RUN b1', 'FROM a'),
+            LayerDivergence(1, 'RUN b2', 'RUN b1'),
+        ),
+        (
+            ('RUN c', 'RUN b', 'FROM a'),
+            ('RUN b', 'FROM a'),
+            LayerDivergence(2, 'RUN c', None),
+        ),
+        (
+            ('FROM a',),
+            ('RUN b', 'FROM a'),
+            LayerDivergence(1, None, 'RUN b'),
+        ),
+    ),
+)
+def test_find_divergence(source_history, target_history, expected):
+    backend = FakeBackend()
+    backend.add_local_image('img:new', source_history, 'pkgs')
+    backend.add_local_image('img:latest', target_history, 'pkgs')
+    assert find_divergence(backend, 'img:new', 'img:latest') == expected
+
+
+def test_get_commands_hash_empty_history():
+    backend = FakeBackend()
+    backend.add_local_image('img:new', (), 'pkgs')
+    assert get_commands_hash(backend, 'img:new') == (
+        'e3b0c44298fc1c149afbf4c8996fb92427ae41e4649b934ca495991b7852b855'
+    )